@@ -1,7 +1,45 @@
-import whisper_timestamped as whisper
-from moviepy.editor import TextClip, CompositeVideoClip
+import os
+import bisect
+import functools
+import ctranslate2
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
+import numpy as np
+from numba import njit
+from PIL import Image, ImageDraw, ImageFont
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Union
+
+# Sample rate Whisper expects its input waveform in
+WHISPER_SAMPLE_RATE = 16000
+
+# Audio files transcribed together are joined with this much silence in between,
+# and at most this many files are joined per Whisper call
+BATCH_GAP_SEC = 2.0
+BATCH_GROUP_SIZE = 8
+
+# Quantized weights halve the memory traffic of the decoder; CPUs have no fast FP16 path
+COMPUTE_TYPES = {"cuda": "int8_float16", "cpu": "int8"}
+
+# Caption fonts to try in order; Pillow also searches the system font directories
+CAPTION_FONTS = ("DejaVuSans.ttf", "Arial.ttf", "Helvetica.ttc")
+_FONTS = {}
+
+# The Whisper pipeline is loaded lazily on first use and shared by every audio file
+_MODEL = None
+
+def _get_model() -> BatchedInferencePipeline:
+    global _MODEL
+    if _MODEL is None:
+        device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+        model = WhisperModel("base", device=device, compute_type=COMPUTE_TYPES[device])  # Use base model for faster processing
+        _MODEL = BatchedInferencePipeline(model=model)
+    return _MODEL
+
+def unload_model() -> None:
+    """Drop the Whisper pipeline so its weights are freed once transcription is done."""
+    global _MODEL
+    _MODEL = None
 
 @dataclass
 class CaptionPhrase:
@@ -9,102 +47,246 @@ class CaptionPhrase:
     start_time: float
     end_time: float
 
-def group_words_into_phrases(words: List[Dict[str, Any]], target_words_per_phrase: int = 5) -> List[CaptionPhrase]:
+@njit(cache=True)
+def _compute_breaks(starts: np.ndarray, ends: np.ndarray, target_words_per_phrase: int) -> np.ndarray:
     """
-    Group words into natural phrases for captioning.
-    Uses a combination of timing and number of words to create natural breaks.
+    Return the index of the first word of every phrase, followed by the number of words.
     """
-    phrases = []
-    current_words = []
-    current_start = 0
-    
-    for word in words:
-        text = word["text"].strip()
-        start = word["start"]
-        end = word["end"]
-        
+    n = len(starts)
+    breaks = np.empty(n + 1, dtype=np.int64)
+    num_breaks = 0
+    current_start = 0.0
+    current_count = 0
+
+    for i in range(n):
         # Start a new phrase if:
         # 1. This is the first word
         # 2. We've reached our target word count
         # 3. There's a significant pause (> 0.7s)
         # 4. The current phrase would be too long to read
-        if (not current_words or 
-            len(current_words) >= target_words_per_phrase or
-            (start - current_words[-1]["end"] > 0.7) or
-            (end - current_start > 4.0)):
-            
-            if current_words:
-                # Create a phrase from accumulated words
-                phrase_text = " ".join(w["text"].strip() for w in current_words)
-                phrases.append(CaptionPhrase(
-                    text=phrase_text,
-                    start_time=current_words[0]["start"],
-                    end_time=current_words[-1]["end"]
-                ))
-            current_words = []
-            current_start = start
-        
-        current_words.append(word)
-    
-    # Don't forget the last phrase
-    if current_words:
-        phrase_text = " ".join(w["text"].strip() for w in current_words)
-        phrases.append(CaptionPhrase(
-            text=phrase_text,
-            start_time=current_words[0]["start"],
-            end_time=current_words[-1]["end"]
-        ))
-    
-    return phrases
-
-def create_caption_clips(phrases: List[CaptionPhrase], 
-                        video_size: tuple,
-                        fontsize: int = 45) -> List[TextClip]:
+        if (i == 0 or
+            current_count >= target_words_per_phrase or
+            (starts[i] - ends[i - 1] > 0.7) or
+            (ends[i] - current_start > 4.0)):
+            breaks[num_breaks] = i
+            num_breaks += 1
+            current_start = starts[i]
+            current_count = 0
+        current_count += 1
+
+    breaks[num_breaks] = n
+    return breaks[:num_breaks + 1]
+
+def group_words_into_phrases(words: List[Dict[str, Any]], target_words_per_phrase: int = 5) -> List[CaptionPhrase]:
     """
-    Create a list of TextClips for each phrase with proper timing and styling.
+    Group words into natural phrases for captioning.
+    Uses a combination of timing and number of words to create natural breaks.
     """
-    caption_clips = []
-    bounded_width = int(video_size[0] * 0.8)  # Bound the text to 80% of the video width
+    if not words:
+        return []
+
+    # Keep the texts and timings in contiguous arrays instead of looking them up per word
+    texts = [w["text"].strip() for w in words]
+    starts = np.fromiter((w["start"] for w in words), dtype=np.float64, count=len(words))
+    ends = np.fromiter((w["end"] for w in words), dtype=np.float64, count=len(words))
+    breaks = _compute_breaks(starts, ends, target_words_per_phrase).tolist()
+
+    # Create a phrase from the words between each pair of breaks
+    return [CaptionPhrase(text=" ".join(texts[i:j]),
+                          start_time=float(starts[i]),
+                          end_time=float(ends[j - 1]))
+            for i, j in zip(breaks[:-1], breaks[1:])]
 
-    for phrase in phrases:
-        # Create text clip with automatic text wrapping using the caption method
-        clip = (TextClip(phrase.text, 
-                        fontsize=fontsize,
-                        color='white',
-                        method='caption',
-                        size=(bounded_width, None))
-                .set_position('center')  # Center both horizontally and vertically
-                .set_start(phrase.start_time)
-                .set_duration(phrase.end_time - phrase.start_time))
+# Compile the phrase grouping at import time so the first transcript doesn't pay for it
+_compute_breaks(np.zeros(1), np.zeros(1), 5)
+
+def _get_font(fontsize: int) -> ImageFont.FreeTypeFont:
+    """
+    Load the caption font once per size and reuse it for every phrase.
+    """
+    if fontsize not in _FONTS:
+        for font_name in CAPTION_FONTS:
+            try:
+                _FONTS[fontsize] = ImageFont.truetype(font_name, fontsize)
+                break
+            except OSError:
+                continue
+        else:
+            raise OSError(f"None of the caption fonts {CAPTION_FONTS} could be found")
+    return _FONTS[fontsize]
+
+def _wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> List[str]:
+    """
+    Greedily wrap text into lines that fit within max_width pixels.
+    """
+    lines = []
+    current_line = ""
+    for word in text.split():
+        candidate = f"{current_line} {word}" if current_line else word
+        if current_line and font.getlength(candidate) > max_width:
+            lines.append(current_line)
+            current_line = word
+        else:
+            current_line = candidate
+    if current_line:
+        lines.append(current_line)
+    return lines or [""]
 
-        caption_clips.append(clip)
+@functools.lru_cache(maxsize=4096)
+def _render_text_array(text: str, fontsize: int, width: int) -> np.ndarray:
+    """
+    Rasterize centered, wrapped white text onto a transparent RGBA image of the given width.
+    Results are cached, so repeated phrases are only laid out once; the array is read-only.
+    """
+    font = _get_font(fontsize)
+    lines = _wrap_text(text, font, width)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
 
-    return caption_clips
+    image = Image.new("RGBA", (width, line_height * len(lines)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        x = (width - font.getlength(line)) / 2
+        draw.text((x, i * line_height), line, font=font, fill=(255, 255, 255, 255))
+    array = np.array(image)
+    array.flags.writeable = False  # Shared between every clip showing this phrase
+    return array
 
-def transcribe_audio(audio_path: str) -> dict:
+def transcribe_audio(audio: Union[str, np.ndarray], clip_timestamps: Optional[List[Dict[str, int]]] = None) -> dict:
     """
-    Transcribe audio file using Whisper and return the result.
+    Transcribe an audio file path or a 16 kHz mono float32 waveform using faster-whisper.
+    clip_timestamps optionally gives the sample ranges to decode, one chunk each, instead of running VAD.
+    The result mirrors the whisper_timestamped layout: {"segments": [{"words": [...]}]}
     """
-    audio = whisper.load_audio(audio_path)
-    model = whisper.load_model("base")  # Use base model for faster processing
-    result = whisper.transcribe(model, audio, language="en")
+    segments, _ = _get_model().transcribe(audio, batch_size=16, word_timestamps=True, language="en",
+                                          clip_timestamps=clip_timestamps)
+
+    result = {"segments": []}
+    for segment in segments:
+        words = [{"text": word.word, "start": word.start, "end": word.end}
+                 for word in (segment.words or [])]
+        result["segments"].append({
+            "text": segment.text,
+            "start": segment.start,
+            "end": segment.end,
+            "words": words
+        })
     return result
 
-def generate_caption_clips(audio_path: str, video_size: tuple) -> List[TextClip]:
+def _speech_clips(waveform: np.ndarray, offset: int) -> List[Dict[str, int]]:
+    """
+    Find the speech chunks of one waveform the way the batched pipeline's own VAD does,
+    shifted by offset samples so they index into the joined audio.
+    """
+    vad_options = VadOptions(max_speech_duration_s=_get_model().model.feature_extractor.chunk_length,
+                             min_silence_duration_ms=160)
+    clips = merge_segments(get_speech_timestamps(waveform, vad_options), vad_options)
+    return [{"start": clip["start"] + offset, "end": clip["end"] + offset} for clip in clips]
+
+def write_caption_track(phrases: List[CaptionPhrase],
+                        video_size: tuple,
+                        output_dir: str,
+                        fontsize: int = 45) -> str:
     """
-    Main function to generate caption clips from an audio file.
+    Write the captions as a single overlay track: one transparent PNG per phrase
+    plus an ffconcat script that shows each image during its phrase and a blank image in between.
+    Every image is bounded_width wide and as tall as the tallest caption, so the track can be
+    centered on the frame with one overlay. Returns the path of the script.
     """
-    # Get transcription with timestamps
-    result = transcribe_audio(audio_path)
-    
+    bounded_width = int(video_size[0] * 0.8)  # Bound the text to 80% of the video width
+    text_arrays = [_render_text_array(phrase.text, fontsize, bounded_width) for phrase in phrases]
+    track_height = max((array.shape[0] for array in text_arrays), default=1)
+
+    def save_image(image_name, text_array=None):
+        # Center the text vertically on a track-sized canvas; PNG compression is kept
+        # minimal since the files only live until ffmpeg has read them
+        canvas = np.zeros((track_height, bounded_width, 4), dtype=np.uint8)
+        if text_array is not None:
+            top = (track_height - text_array.shape[0]) // 2
+            canvas[top:top + text_array.shape[0]] = text_array
+        Image.fromarray(canvas).save(os.path.join(output_dir, image_name), compress_level=1)
+
+    blank_name = "blank.png"
+    save_image(blank_name)
+    lines = ["ffconcat version 1.0"]
+    current_time = 0.0
+
+    for i, (phrase, text_array) in enumerate(zip(phrases, text_arrays)):
+        if phrase.end_time <= max(phrase.start_time, current_time):
+            continue
+        if phrase.start_time > current_time:
+            lines += [f"file {blank_name}", f"duration {phrase.start_time - current_time:.3f}"]
+            current_time = phrase.start_time
+
+        image_name = f"caption_{i:05d}.png"
+        save_image(image_name, text_array)
+
+        lines += [f"file {image_name}", f"duration {phrase.end_time - current_time:.3f}"]
+        current_time = phrase.end_time
+
+    # The concat demuxer ignores the duration of the last entry, so end on a repeated blank frame
+    lines += [f"file {blank_name}", "duration 0.100", f"file {blank_name}"]
+
+    track_path = os.path.join(output_dir, "captions.ffconcat")
+    with open(track_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return track_path
+
+def _extract_words(result: dict) -> List[Dict[str, Any]]:
     # Extract all words with their timestamps
     words = []
     for segment in result["segments"]:
         if "words" in segment:
             words.extend(segment["words"])
-    
-    # Group words into natural phrases
-    phrases = group_words_into_phrases(words)
-    
-    # Create caption clips
-    return create_caption_clips(phrases, video_size) 
\ No newline at end of file
+    return words
+
+def transcribe_batch(waveforms: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+    """
+    Transcribe several 16 kHz mono waveforms and return the words of each one.
+    Files of similar duration are joined (separated by silence) and transcribed together,
+    so Whisper can fill its batches with chunks from several files; each chunk stays within one file.
+    """
+    words_per_file = [[] for _ in waveforms]
+    gap = np.zeros(int(BATCH_GAP_SEC * WHISPER_SAMPLE_RATE), dtype=np.float32)
+
+    # Group files by similar duration so one long file doesn't leave short ones waiting
+    order = sorted(range(len(waveforms)), key=lambda i: len(waveforms[i]))
+    for group_start in range(0, len(order), BATCH_GROUP_SIZE):
+        group = order[group_start:group_start + BATCH_GROUP_SIZE]
+
+        # Remember where each file starts and ends in the joined audio, and run VAD per file
+        # so no decoded chunk (and no decoder context) spans two files
+        offsets = []
+        file_ends = []
+        clip_timestamps = []
+        position = 0
+        for i in group:
+            offsets.append(position / WHISPER_SAMPLE_RATE)
+            file_ends.append((position + len(waveforms[i])) / WHISPER_SAMPLE_RATE)
+            clip_timestamps += _speech_clips(waveforms[i], position)
+            position += len(waveforms[i]) + len(gap)
+        if not clip_timestamps:
+            continue  # No speech in any of these files
+        joined = np.concatenate([piece for i in group for piece in (waveforms[i], gap)])
+
+        # Hand each word back to the file it was spoken in, relative to that file's start.
+        # A word stamped inside the silence after a file belongs to the next one,
+        # since Whisper tends to stretch the first word after a pause back into it
+        for word in _extract_words(transcribe_audio(joined, clip_timestamps)):
+            k = min(bisect.bisect_right(file_ends, word["start"]), len(group) - 1)
+            file_duration = file_ends[k] - offsets[k]
+            start = min(max(word["start"] - offsets[k], 0.0), file_duration)
+            words_per_file[group[k]].append({
+                "text": word["text"],
+                "start": start,
+                "end": min(max(word["end"] - offsets[k], start), file_duration)
+            })
+
+    return words_per_file
+
+def generate_caption_phrases_batch(waveforms: List[np.ndarray]) -> List[List[CaptionPhrase]]:
+    """
+    Transcribe several 16 kHz mono waveforms in as few Whisper calls as possible and
+    group each one's words into timed caption phrases.
+    """
+    return [group_words_into_phrases(words) for words in transcribe_batch(waveforms)]
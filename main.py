@@ -1,15 +1,34 @@
 import os
-import glob
+import gc
 import numpy as np
-from moviepy.editor import VideoFileClip, AudioFileClip, concatenate_videoclips, CompositeVideoClip, vfx
+from moviepy.config import get_setting
+from moviepy.editor import AudioFileClip
 import random
+import re
+import shutil
 import sys
-from caption_generator import generate_caption_clips
+import subprocess
+import tempfile
+import multiprocessing
+from caption_generator import WHISPER_SAMPLE_RATE, generate_caption_phrases_batch, unload_model, write_caption_track
 import time
 
 # TikTok recommended resolution
 VERTICAL_WIDTH = 1080
 VERTICAL_HEIGHT = 1920
+FPS = 24
+FADE_DURATION = 1.2
+# Length of the slice taken from each video asset
+SUBCLIP_SEC = 5.0
+
+# Use the same ffmpeg binary moviepy is configured with
+FFMPEG_BINARY = get_setting('FFMPEG_BINARY')
+# moviepy's bundled ffmpeg has no CUDA support, so the GPU path uses the system ffmpeg
+# (or FFMPEG_GPU_BINARY) when that one can actually encode with NVENC
+GPU_FFMPEG_BINARY = os.environ.get('FFMPEG_GPU_BINARY') or shutil.which('ffmpeg')
+# At most this many clips per video are decoded with NVDEC; the rest are decoded and scaled
+# on the CPU, since every input keeps its own decoder open for the whole render
+CUDA_DECODE_LIMIT = 8
 
 def load_audio(audio_filename):
     # Use the provided audio_filename to locate the file in the AudioAssets folder
@@ -17,82 +36,71 @@ def load_audio(audio_filename):
     if not os.path.isfile(audio_path):
         raise FileNotFoundError(f'Audio file {audio_path} not found')
     print(f'Using audio file: {audio_path}')
-    audio = AudioFileClip(audio_path)
+    # Decode at Whisper's sample rate so the same decode also feeds transcription
+    audio = AudioFileClip(audio_path, fps=WHISPER_SAMPLE_RATE)
     return audio
 
+def load_waveform(audio_filename):
+    # Decode the audio as the mono float32 waveform Whisper expects and return it with the file path
+    # (the chunks are stacked here because moviepy's to_soundarray hands numpy a generator)
+    audio = load_audio(audio_filename)
+    try:
+        chunks = list(audio.iter_chunks(fps=WHISPER_SAMPLE_RATE, chunksize=50000))
+    finally:
+        audio.close()
+    return audio.filename, np.vstack(chunks).mean(axis=1).astype(np.float32)
+
 def load_video_assets():
-    # Look for common video file extensions in VideoAssets folder
-    video_extensions = ('*.mp4', '*.mov', '*.avi', '*.mkv')
-    video_files = []
-    for ext in video_extensions:
-        video_files.extend(glob.glob(os.path.join('VideoAssets', ext)))
+    # Look for common video file extensions in VideoAssets folder with a single directory scan
+    video_extensions = {'.mp4', '.mov', '.avi', '.mkv'}
+    with os.scandir('VideoAssets') as entries:
+        video_files = [entry.path for entry in entries
+                       if entry.is_file() and os.path.splitext(entry.name)[1].lower() in video_extensions]
     if not video_files:
         raise FileNotFoundError('No video files found in VideoAssets')
-    random.shuffle(video_files)  # Randomize the order of the video files
     print(f'Found {len(video_files)} video files.')
     return video_files
 
-def resize_clip_vertical(clip):
-    """
-    Resize and crop the clip to vertical format while maintaining aspect ratio.
-    This ensures the video fills the vertical space without distortion.
-    """
-    # Get the original size
-    w, h = clip.size
-    
-    # Calculate target size maintaining aspect ratio
-    target_ratio = VERTICAL_WIDTH / VERTICAL_HEIGHT
-    current_ratio = w / h
-    
-    if current_ratio > target_ratio:
-        # Video is too wide, scale based on height
-        new_height = VERTICAL_HEIGHT
-        new_width = int(new_height * current_ratio)
-        resized = clip.resize(height=new_height)
-        # Crop the excess width from the center
-        x_center = new_width // 2
-        x1 = x_center - (VERTICAL_WIDTH // 2)
-        return resized.crop(x1=x1, y1=0, x2=x1+VERTICAL_WIDTH, y2=VERTICAL_HEIGHT)
-    else:
-        # Video is too tall, scale based on width
-        new_width = VERTICAL_WIDTH
-        new_height = int(new_width / current_ratio)
-        resized = clip.resize(width=new_width)
-        # Crop the excess height from the center
-        y_center = new_height // 2
-        y1 = y_center - (VERTICAL_HEIGHT // 2)
-        return resized.crop(x1=0, y1=y1, x2=VERTICAL_WIDTH, y2=y1+VERTICAL_HEIGHT)
+def probe_video(video_path):
+    # Read the duration and rotation from the file header without decoding any frames
+    # (moviepy's ffmpeg_parse_infos misses the display-matrix rotation newer ffmpeg reports)
+    result = subprocess.run([FFMPEG_BINARY, '-hide_banner', '-i', video_path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    duration_match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if not duration_match:
+        raise IOError(f'Could not read the duration of {video_path}')
+    hours, minutes, seconds = duration_match.groups()
+    rotation_match = re.search(r'rotation of (-?[\d.]+) degrees|rotate\s*:\s*(-?\d+)', result.stderr)
+    rotation = float(next(g for g in rotation_match.groups() if g)) if rotation_match else 0.0
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds), rotation
 
 def process_video_clip(video_path):
-    # Load the video asset
-    clip = VideoFileClip(video_path)
-    # Create a 5-second clip
-    subclip_duration = min(5.0, clip.duration)
-    base_clip = clip.subclip(0, subclip_duration)
-    
-    # Resize to vertical format
-    resized_clip = resize_clip_vertical(base_clip)
-    
-    # Apply fade-in and fade-out of 1.2 seconds each
-    processed_clip = resized_clip.fx(vfx.fadein, 1.2).fx(vfx.fadeout, 1.2)
-    return processed_clip
+    # Probe the video asset
+    duration, rotation = probe_video(video_path)
+    # Use a 5-second clip
+    subclip_duration = min(SUBCLIP_SEC, duration)
+    return video_path, subclip_duration, rotation
 
 def calculate_needed_clips(target_duration):
-    # Each clip is 5 seconds
-    clip_duration = 5
+    # Each clip is SUBCLIP_SEC seconds
     # Add 1 to round up and ensure we have enough coverage
-    return int(target_duration / clip_duration) + 1
+    return int(target_duration / SUBCLIP_SEC) + 1
 
 def create_video_sequence(video_paths, target_duration):
-    processed_clips = []
+    """
+    Choose the clips for the video as (path, duration, rotation) tuples.
+    video_paths may be any iterable; paths are only probed until the target duration is covered.
+    Nothing is decoded here; the whole sequence is rendered by a single ffmpeg run.
+    """
+    segments = []
     total_duration = 0
     
     # Process only enough clips to reach target duration
     for video_path in video_paths:
         try:
-            clip = process_video_clip(video_path)
-            processed_clips.append(clip)
-            total_duration += clip.duration
+            segment = process_video_clip(video_path)
+            segments.append(segment)
+            total_duration += segment[1]
             
             # If we have enough clips, stop processing more
             if total_duration >= target_duration:
@@ -102,15 +110,161 @@ def create_video_sequence(video_paths, target_duration):
             print(f'Error processing {video_path}: {e}')
             continue
             
-    if not processed_clips:
+    if not segments:
         raise ValueError('No video clips could be processed.')
         
-    # Concatenate clips and handle any excess duration
-    final_sequence = concatenate_videoclips(processed_clips)
-    if final_sequence.duration > target_duration:
-        final_sequence = final_sequence.subclip(0, target_duration)
+    return segments
+
+# Whether this process renders on the GPU; probed on first use
+_USE_CUDA = None
+
+def ffmpeg_supports_cuda():
+    """
+    Check whether GPU_FFMPEG_BINARY can actually scale with scale_cuda and encode with NVENC on this host.
+    A build that merely lists the CUDA filters and encoders isn't enough, so encode one tiny frame.
+    """
+    global _USE_CUDA
+    if _USE_CUDA is None:
+        _USE_CUDA = False
+        if GPU_FFMPEG_BINARY:
+            command = [GPU_FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error',
+                       '-f', 'lavfi', '-i', 'nullsrc=s=256x256', '-frames:v', '1',
+                       '-vf', 'format=nv12,hwupload_cuda,scale_cuda=128:128',
+                       '-c:v', 'h264_nvenc', '-f', 'null', '-']
+            try:
+                result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                _USE_CUDA = result.returncode == 0
+            except OSError:
+                pass
+    return _USE_CUDA
+
+def uses_nvdec(index, rotation, use_cuda):
+    # Rotated clips stay on the CPU decoder, which auto-rotates frames; CUDA frames can't be transposed
+    return use_cuda and index < CUDA_DECODE_LIMIT and rotation % 360 == 0
+
+def build_filter_graph(segments, use_cuda=False):
+    """
+    Build the filter_complex that scales, crops and fades every clip, concatenates them
+    and overlays the caption track.
+    Inputs are the clips, then the caption track, in that order.
+    """
+    filters = []
+    for i, (_, duration, rotation) in enumerate(segments):
+        # Scale to cover the vertical frame while maintaining aspect ratio, then crop the excess
+        # from the center. ffmpeg sizes this from the decoded (auto-rotated) frame.
+        if uses_nvdec(i, rotation, use_cuda):
+            # Scale in VRAM (NV12 needs even sizes), then download for the crop, fades and overlays,
+            # which have no CUDA equivalent
+            scale = (f'scale_cuda={VERTICAL_WIDTH}:{VERTICAL_HEIGHT}:force_original_aspect_ratio=increase:'
+                     f'force_divisible_by=2,hwdownload,format=nv12')
+        else:
+            scale = f'scale={VERTICAL_WIDTH}:{VERTICAL_HEIGHT}:force_original_aspect_ratio=increase'
+        # Apply fade-in and fade-out of 1.2 seconds each
+        fade_out_start = max(0.0, duration - FADE_DURATION)
+        filters.append(f'[{i}:v]{scale},crop={VERTICAL_WIDTH}:{VERTICAL_HEIGHT},'
+                       f'setsar=1,fps={FPS},format=yuv420p,'
+                       f'fade=t=in:st=0:d={FADE_DURATION},fade=t=out:st={fade_out_start:.3f}:d={FADE_DURATION}[v{i}]')
+    filters.append(''.join(f'[v{i}]' for i in range(len(segments))) + f'concat=n={len(segments)}:v=1:a=0[base]')
+
+    # All captions come from one track, so a single overlay layer centers them on the frame
+    filters.append(f'[base][{len(segments)}:v]overlay=x=(W-w)/2:y=(H-h)/2[captioned]')
+    return ';'.join(filters)
+
+def build_ffmpeg_command(segments, caption_track, audio_path, target_duration, output_path, threads, use_cuda=False):
+    command = [GPU_FFMPEG_BINARY if use_cuda else FFMPEG_BINARY, '-y', '-loglevel', 'error']
+    for i, (video_path, duration, rotation) in enumerate(segments):
+        if uses_nvdec(i, rotation, use_cuda):
+            # Decode with NVDEC and keep the frames in VRAM for scale_cuda
+            command += ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+        command += ['-t', f'{duration:.3f}', '-i', video_path]
+    command += ['-f', 'concat', '-i', caption_track]
+    command += ['-i', audio_path]
+
+    filter_graph = build_filter_graph(segments, use_cuda)
+    command += ['-filter_complex', filter_graph,
+                '-map', '[captioned]', '-map', f'{len(segments) + 1}:a',
+                '-t', f'{target_duration:.3f}', '-r', str(FPS)]
+
+    if use_cuda:
+        command += ['-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr', '-cq', '23']
+    else:
+        command += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-tune', 'fastdecode',
+                    '-threads', str(threads)]
+    command += ['-pix_fmt', 'yuv420p', '-c:a', 'aac', output_path]
+    return command
+
+def render_video(segments, caption_track, audio_path, target_duration, output_path, threads):
+    """
+    Render the final video with one ffmpeg process so every frame is decoded, filtered
+    and encoded without passing through Python.
+    Uses NVDEC/NVENC when ffmpeg supports CUDA and falls back to the CPU otherwise.
+    """
+    global _USE_CUDA
+    if ffmpeg_supports_cuda():
+        command = build_ffmpeg_command(segments, caption_track, audio_path,
+                                       target_duration, output_path, threads, use_cuda=True)
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            return
+        # e.g. a codec NVDEC can't decode or no free NVENC session; render the rest of
+        # this process's videos on the CPU instead of failing on the GPU first every time
+        _USE_CUDA = False
+        error_lines = result.stderr.strip().splitlines()
+        print(f'GPU rendering failed, falling back to CPU: {error_lines[-1] if error_lines else result.returncode}')
+
+    command = build_ffmpeg_command(segments, caption_track, audio_path, target_duration, output_path, threads)
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed: {result.stderr.strip()}')
+
+def process_one(audio_filename, audio_path, target_duration, phrases, video_files, encode_threads):
+    """
+    Render the captioned video for a single audio file from its already transcribed phrases.
+    The audio was decoded once for transcription, so only its path and duration are passed in.
+    encode_threads is this worker's share of the CPU cores for the x264 encode.
+    Runs inside a worker process.
+    """
+    try:
+        # Start timing this video
+        video_start_time = time.time()
+        
+        print(f"\nProcessing {audio_filename}...")
+        
+        # Use the actual audio duration
+        print(f"Video duration will be {target_duration:.2f} seconds")
         
-    return final_sequence
+        # Estimate needed clips; shorter clips mean the sequence may use a few more
+        needed_clips = calculate_needed_clips(target_duration)
+        print(f"Expecting about {needed_clips} video clips for this audio")
+        
+        # Create video sequence from a random order of the clips; only the needed ones are probed
+        shuffled_files = iter(random.sample(video_files, k=len(video_files)))
+        segments = create_video_sequence(shuffled_files, target_duration)
+
+        # Create output directory
+        output_dir = os.path.join('OutputVideos')
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Create the output path using a timestamp and the audio name to ensure uniqueness,
+        # since several workers can finish within the same second
+        timestamp = int(time.time())
+        audio_name = os.path.splitext(os.path.basename(audio_filename))[0]
+        output_path = os.path.join(output_dir, f'video_{timestamp}_{audio_name}.mp4')
+        
+        print(f"Rendering final video as {output_path}...")
+        with tempfile.TemporaryDirectory() as caption_dir:
+            caption_track = write_caption_track(phrases, (VERTICAL_WIDTH, VERTICAL_HEIGHT), caption_dir)
+            render_video(segments, caption_track, audio_path, target_duration, output_path, encode_threads)
+        
+        # Calculate and display time taken for this video
+        video_end_time = time.time()
+        video_duration = video_end_time - video_start_time
+        minutes = int(video_duration // 60)
+        seconds = int(video_duration % 60)
+        print(f"\nCompleted {audio_filename} in {minutes} minutes and {seconds} seconds")
+        
+    except Exception as e:
+        print(f"Error processing {audio_filename}: {e}")
 
 def main():
     # Ask for user input
@@ -131,60 +285,58 @@ def main():
     # Start timing the total process
     total_start_time = time.time()
     
+    # Scan the video assets once; each audio file draws its own random order from them
+    try:
+        video_files = load_video_assets()
+    except FileNotFoundError as e:
+        print(f"{e}. Exiting...")
+        sys.exit(1)
+    
+    # Transcribe every audio file up front so Whisper can batch them together
+    print("\nGenerating captions from audio...")
+    loaded_files = []
+    waveforms = []
     for audio_filename in audio_files:
         try:
-            # Start timing this video
-            video_start_time = time.time()
-            
-            print(f"\nProcessing {audio_filename}...")
-            
-            # Load audio using the provided filename
-            audio = load_audio(audio_filename)
-            
-            # Use the actual audio duration
-            target_duration = audio.duration
-            print(f"Video duration will be {target_duration:.2f} seconds")
-            
-            # Load video assets paths and calculate needed clips
-            video_files = load_video_assets()
-            needed_clips = calculate_needed_clips(target_duration)
-            print(f"Will process {needed_clips} video clips for this audio")
-            
-            # Create video sequence with only the needed clips
-            final_video = create_video_sequence(video_files[:needed_clips * 2], target_duration)
-
-            # Generate caption clips
-            print("Generating captions from audio...")
-            audio_path = os.path.join('AudioAssets', audio_filename)
-            caption_clips = generate_caption_clips(audio_path, (VERTICAL_WIDTH, VERTICAL_HEIGHT))
-
-            # Combine video with captions
-            final_output = CompositeVideoClip([final_video] + caption_clips, size=(VERTICAL_WIDTH, VERTICAL_HEIGHT))
-
-            # Set the audio
-            final_output = final_output.set_audio(audio)
-
-            # Create output directory
-            output_dir = os.path.join('OutputVideos')
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Create the output path using a timestamp to ensure uniqueness
-            timestamp = int(time.time())
-            output_path = os.path.join(output_dir, f'video_{timestamp}.mp4')
-            
-            print(f"Rendering final video as {output_path}...")
-            final_output.write_videofile(output_path, fps=24, audio_codec='aac')
-            
-            # Calculate and display time taken for this video
-            video_end_time = time.time()
-            video_duration = video_end_time - video_start_time
-            minutes = int(video_duration // 60)
-            seconds = int(video_duration % 60)
-            print(f"\nCompleted {audio_filename} in {minutes} minutes and {seconds} seconds")
-            
+            audio_path, waveform = load_waveform(audio_filename)
+            waveforms.append(waveform)
+            loaded_files.append((audio_filename, audio_path, len(waveform) / WHISPER_SAMPLE_RATE))
         except Exception as e:
             print(f"Error processing {audio_filename}: {e}")
-            continue
+    try:
+        phrases_per_file = generate_caption_phrases_batch(waveforms)
+    except Exception as e:
+        # Fall back to one file at a time so a single bad file doesn't sink the whole batch
+        print(f"Error generating captions in batch: {e}")
+        transcribed_files = []
+        phrases_per_file = []
+        for loaded_file, waveform in zip(loaded_files, waveforms):
+            try:
+                phrases_per_file += generate_caption_phrases_batch([waveform])
+                transcribed_files.append(loaded_file)
+            except Exception as e:
+                print(f"Error processing {loaded_file[0]}: {e}")
+        loaded_files = transcribed_files
+    
+    # The workers only need the phrases, so free the model and waveforms before forking
+    # instead of copying them into every worker
+    del waveforms
+    unload_model()
+    gc.collect()
+    
+    # Probe the GPU once here so forked workers inherit the result instead of each probing again
+    if ffmpeg_supports_cuda():
+        print(f"Rendering on the GPU with {GPU_FFMPEG_BINARY}")
+    
+    # Each audio file is an independent pipeline, so render them in parallel.
+    # Every ffmpeg encode already uses several cores, so keep the pool small and
+    # split the cores between the workers so concurrent encodes don't oversubscribe them.
+    cpu_count = os.cpu_count() or 2
+    workers = max(1, min(len(loaded_files), cpu_count // 2))
+    encode_threads = max(1, cpu_count // workers)
+    with multiprocessing.Pool(processes=workers) as pool:
+        pool.starmap(process_one, [(*loaded_file, phrases, video_files, encode_threads)
+                                   for loaded_file, phrases in zip(loaded_files, phrases_per_file)])
     
     # Calculate and display total time taken
     total_end_time = time.time()